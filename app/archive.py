@@ -0,0 +1,196 @@
+# app/archive.py
+"""
+Move cold calculations out of the database.
+
+Rows created before a cutoff are written to gzip-compressed columnar
+JSON files under ARCHIVE_DIR, one directory per month, then removed
+from the calculations table, so the hot table (and its indexes) only
+holds recent history. Rows are read by id in BULK_CHUNK_SIZE batches and
+collected until ARCHIVE_PART_ROWS are buffered; those are then written
+as one part file per month and deleted, so memory stays bounded however
+much history there is. Running it again skips ids that are already
+archived, so an interrupted run can simply be repeated.
+
+Archived rows leave the change feed without a tombstone or stream event:
+they are old by definition, and sync clients that keep history longer
+than the retention window should prune it themselves by created_at.
+Change versions come from their own counter, so archiving never makes
+a version get reused.
+
+    python -m app.archive --older-than-days 90
+"""
+import argparse
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from . import models
+from .crud import BULK_CHUNK_SIZE, record_archived, time_bound
+from .db import SessionLocal
+
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", "archive"))
+# Rows buffered before they are written out and deleted
+ARCHIVE_PART_ROWS = int(os.getenv("ARCHIVE_PART_ROWS", "50000"))
+
+COLUMNS = ["id", "a", "b", "type", "result", "user_id", "version", "deleted", "job_id", "created_at"]
+
+
+def month_dir(archive_dir: Path, month: str) -> Path:
+    return archive_dir / f"calculations-{month}"
+
+
+def _read_part(path: Path) -> dict[str, list]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)["columns"]
+
+
+def read_archive(directory: Path) -> dict[str, list]:
+    """Return {column: values} for one month, all part files merged."""
+    columns = {name: [] for name in COLUMNS}
+    for part in sorted(directory.glob("part-*.json.gz")):
+        block = _read_part(part)
+        for name in COLUMNS:
+            columns[name].extend(block[name])
+    return columns
+
+
+def _part_ranges(directory: Path) -> list[tuple[int, int, Path]]:
+    """(first id, last id, path) of each part, from the file names."""
+    ranges = []
+    for part in directory.glob("part-*.json.gz"):
+        first, last = part.name[len("part-"):-len(".json.gz")].split("-")
+        ranges.append((int(first), int(last), part))
+    return ranges
+
+
+def _already_archived(parts: list[tuple[int, int, Path]], records: list[dict]) -> set[int]:
+    """
+    Ids among `records` that are already on disk (left by an interrupted
+    run). Only parts whose id range overlaps the records are opened.
+    """
+    low, high = records[0]["id"], records[-1]["id"]
+    ids = set()
+    for first, last, part in parts:
+        if first <= high and last >= low:
+            ids.update(_read_part(part)["id"])
+    return ids
+
+
+def _write_part(directory: Path, records: list[dict]) -> tuple[int, int, Path]:
+    columns = {name: [] for name in COLUMNS}
+    for record in records:
+        for name in COLUMNS:
+            value = record[name]
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            columns[name].append(value)
+
+    directory.mkdir(parents=True, exist_ok=True)
+    first, last = records[0]["id"], records[-1]["id"]
+    path = directory / f"part-{first:012d}-{last:012d}.json.gz"
+    # Write under another name and rename, so a crash never leaves a
+    # half-written part behind
+    tmp = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump({"columns": columns}, f)
+    os.replace(tmp, path)
+    return first, last, path
+
+
+def archive_calculations(
+    db: Session,
+    before: datetime,
+    archive_dir: Optional[Path] = None,
+    part_rows: Optional[int] = None,
+) -> dict[str, int]:
+    """
+    Archive and remove calculations created before `before`.
+    Returns the number of rows archived per month ("YYYY-MM").
+    """
+    archive_dir = Path(archive_dir or ARCHIVE_DIR)
+    part_rows = part_rows or ARCHIVE_PART_ROWS
+    cutoff = time_bound(db, before)
+    archived: dict[str, int] = defaultdict(int)
+    # Part files per month, listed the first time the month comes up
+    parts: dict[str, list[tuple[int, int, Path]]] = {}
+    pending: dict[str, list[dict]] = defaultdict(list)
+    buffered = 0
+
+    def flush() -> None:
+        ids = []
+        for month, records in pending.items():
+            directory = month_dir(archive_dir, month)
+            if month not in parts:
+                parts[month] = _part_ranges(directory)
+            done = _already_archived(parts[month], records)
+            new_records = [r for r in records if r["id"] not in done]
+            if new_records:
+                parts[month].append(_write_part(directory, new_records))
+            archived[month] += len(records)
+            ids.extend(r["id"] for r in records)
+
+        # Only remove rows once they are safely on disk
+        for i in range(0, len(ids), BULK_CHUNK_SIZE):
+            db.execute(
+                delete(models.Calculation).where(
+                    models.Calculation.id.in_(ids[i:i + BULK_CHUNK_SIZE])
+                )
+            )
+        # Changes the list's ETag, which the change version alone would not
+        record_archived(db)
+        db.commit()
+        pending.clear()
+
+    columns = [getattr(models.Calculation, name) for name in COLUMNS]
+    last_id = 0
+    while True:
+        rows = (
+            db.query(*columns)
+            .filter(
+                models.Calculation.created_at < cutoff,
+                models.Calculation.id > last_id,
+            )
+            .order_by(models.Calculation.id)
+            .limit(BULK_CHUNK_SIZE)
+            .all()
+        )
+        for row in rows:
+            record = row._asdict()
+            pending[record["created_at"].strftime("%Y-%m")].append(record)
+        buffered += len(rows)
+
+        if buffered and (buffered >= part_rows or not rows):
+            flush()
+            buffered = 0
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+    return dict(archived)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Archive old calculations.")
+    parser.add_argument("--older-than-days", type=int, default=90)
+    parser.add_argument("--dir", type=Path, default=ARCHIVE_DIR)
+    args = parser.parse_args(argv)
+
+    before = datetime.now(timezone.utc) - timedelta(days=args.older_than_days)
+    db = SessionLocal()
+    try:
+        archived = archive_calculations(db, before, args.dir)
+    finally:
+        db.close()
+    for month, count in sorted(archived.items()):
+        print(f"{month}: {count} rows")
+
+
+if __name__ == "__main__":
+    main()
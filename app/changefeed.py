@@ -0,0 +1,146 @@
+# app/changefeed.py
+"""
+Publishes committed calculation changes to this process's event broker.
+
+Every server worker process runs one ChangeTailer. It follows the change
+counter and the version column, so a write made by any process reaches
+the /calculations/stream connections of every process, in version order,
+with the version as the event id. crud wakes the local tailer with
+broker.notify() after a write; otherwise it polls every TAIL_POLL_SECONDS.
+
+Each version becomes one event:
+
+- one live row: "created" (or "updated"), data is the calculation;
+- one tombstone: "deleted", data is its id, user_id and version;
+- several rows (bulk update/delete, a job chunk): "bulk", data is the
+  action, the row count and the version.
+
+Like GET /calculations/changes, this follows rows, not a log: a row
+written twice between two polls is reported once, at its latest version.
+
+Whether a row is new is judged by its id being above every id the tailer
+has already seen. Clients treat "created" and "updated" the same way
+(upsert), so a concurrent insert reported as "updated" does no harm.
+"""
+import logging
+import os
+import threading
+from typing import Callable, Optional
+
+from . import crud, schemas
+from .db import SessionLocal
+from .events import Event, broker as default_broker
+
+logger = logging.getLogger(__name__)
+
+TAIL_POLL_SECONDS = float(os.getenv("TAIL_POLL_SECONDS", "0.5"))
+# Versions summarised per query while catching up
+TAIL_BATCH_VERSIONS = 1000
+
+
+class ChangeTailer:
+    def __init__(self, session_factory=SessionLocal, broker=default_broker):
+        self.session_factory = session_factory
+        self.broker = broker
+        # Last version published; None until the first poll
+        self.version: Optional[int] = None
+        self._max_id = 0
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Called after every poll that published something, e.g. to drop
+        # cached reads: the tailer sees the writes of every process
+        self.listeners: list[Callable[[], None]] = []
+
+    def start(self) -> None:
+        """Called at server startup, in every worker process."""
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="calc-changes-tail", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self.broker.notify()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            # Cleared before polling, so a notify() during the poll is
+            # picked up by the next one
+            self.broker.changed.clear()
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Publishing calculation changes failed")
+            self.broker.changed.wait(TAIL_POLL_SECONDS)
+
+    def poll(self) -> int:
+        """
+        Publish the versions committed since the last poll; returns how
+        many. The first poll only records where to start from.
+        """
+        db = self.session_factory()
+        try:
+            watermark = crud.current_version(db)
+            if self.version is None:
+                self.version = watermark
+                self._max_id = crud.max_calculation_id(db)
+                self.broker.start_at(watermark)
+                return 0
+
+            published = 0
+            while self.version < watermark:
+                until = crud.get_change_bound(
+                    db, since=self.version, until=watermark, limit=TAIL_BATCH_VERSIONS
+                )
+                versions = crud.get_change_versions(db, since=self.version, until=until)
+                singles = [v["version"] for v in versions if v["count"] == 1]
+                rows = {row.version: row for row in crud.get_version_rows(db, singles)}
+                for summary in versions:
+                    event = self._event(summary, rows.get(summary["version"]))
+                    if event is not None:
+                        self.broker.publish(event)
+                        published += 1
+                    self._max_id = max(self._max_id, summary["max_id"])
+                    # Advanced per version, so a failure part way through
+                    # never publishes a version twice
+                    self.version = summary["version"]
+                # Versions without rows (a job chunk where every item
+                # failed, archived rows) are simply skipped
+                self.version = until
+            if published:
+                for listener in self.listeners:
+                    listener()
+            return published
+        finally:
+            db.close()
+
+    def _event(self, summary: dict, row) -> Optional[Event]:
+        version = summary["version"]
+        if summary["count"] == 1 and row is None:
+            # Rewritten since the summary was read; it is published at
+            # its newer version
+            return None
+        if row is not None and row.deleted:
+            type_ = "deleted"
+            data = {"id": row.id, "user_id": row.user_id, "version": version}
+        elif row is not None:
+            type_ = "created" if row.id > self._max_id else "updated"
+            data = schemas.CalculationRead.model_validate(row).model_dump(mode="json")
+        else:
+            type_ = "bulk"
+            if summary["deleted"] == summary["count"]:
+                action = "deleted"
+            elif summary["min_id"] > self._max_id:
+                action = "created"
+            else:
+                action = "updated"
+            data = {"action": action, "count": summary["count"], "version": version}
+            if action == "created" and summary["job_id"] is not None:
+                data["job_id"] = summary["job_id"]
+        return Event(
+            id=version, type=type_, user_ids=frozenset(summary["user_ids"]), data=data
+        )
+
+
+tailer = ChangeTailer()
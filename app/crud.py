@@ -1,10 +1,15 @@
 # app/crud.py
+import json
+from datetime import datetime, timezone
 from typing import Optional
 
 from fastapi import HTTPException, status
+from sqlalchemy import case, func, insert, literal, update
 from sqlalchemy.orm import Session
 
 from . import models, schemas
+from .events import broker
+from .operations import DIVISION_TYPES, OPERATIONS, SQL_OPERATIONS, compute
 from .security import hash_password
 
 # ---------------- USER HELPERS ---------------- #
@@ -41,36 +46,256 @@ def create_user(db: Session, user_in: schemas.UserCreate) -> models.User:
 
 # ---------------- CALCULATION HELPERS ---------------- #
 
-VALID_TYPES = {"add", "sub", "subtract", "mul", "multiply", "div", "divide"}
+VALID_TYPES = set(OPERATIONS)
+
+# Rows per statement in bulk operations, to keep each lock short
+BULK_CHUNK_SIZE = 500
 
 
 def _compute_result(a: float, b: float, type_: str) -> float:
-    if type_ in ("add",):
-        return a + b
-    elif type_ in ("sub", "subtract"):
-        return a - b
-    elif type_ in ("mul", "multiply"):
-        return a * b
-    elif type_ in ("div", "divide"):
-        if b == 0:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Division by zero",
-            )
-        return a / b
-    else:
+    try:
+        return compute(a, b, type_)
+    except (ValueError, ZeroDivisionError) as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid calculation type",
+            detail=str(e),
         )
 
 
+def _live_calculations(db: Session):
+    return db.query(models.Calculation).filter(models.Calculation.deleted.is_(False))
+
+
 def get_calculation(db: Session, calc_id: int) -> Optional[models.Calculation]:
-    return db.query(models.Calculation).filter(models.Calculation.id == calc_id).first()
+    return _live_calculations(db).filter(models.Calculation.id == calc_id).first()
+
+
+def time_bound(db: Session, value: datetime) -> datetime:
+    """
+    Prepare a datetime for comparing with a created_at column. Naive
+    values are taken as UTC. SQLite stores UTC without an offset, so the
+    bound is made naive there; other databases get an aware value, since
+    a naive one would be read in the session's time zone.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    value = value.astimezone(timezone.utc)
+    if db.get_bind().dialect.name == "sqlite":
+        return value.replace(tzinfo=None)
+    return value
+
+
+def get_calculations(
+    db: Session,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+):
+    """
+    Live calculations, optionally limited to created_from <= created_at <
+    created_to. The range is answered from the created_at index, so it
+    only touches the rows in that window.
+    """
+    query = _live_calculations(db)
+    if created_from is not None:
+        query = query.filter(models.Calculation.created_at >= time_bound(db, created_from))
+    if created_to is not None:
+        query = query.filter(models.Calculation.created_at < time_bound(db, created_to))
+    return query.all()
+
+
+CALCULATIONS_COUNTER = "calculations"
+# Bumped for every batch of rows archive_calculations() removes
+ARCHIVE_COUNTER = "calculations-archive"
 
 
-def get_calculations(db: Session):
-    return db.query(models.Calculation).all()
+def _counter(db: Session, name: str = CALCULATIONS_COUNTER):
+    return db.query(models.ChangeCounter).filter(models.ChangeCounter.name == name)
+
+
+def ensure_change_counter(db: Session) -> None:
+    """
+    Create the version counter if it is missing, starting after the
+    highest version already in the table (databases made before it),
+    and the archive counter.
+    """
+    if _counter(db).first() is None:
+        start = db.query(func.coalesce(func.max(models.Calculation.version), 0)).scalar()
+        db.add(models.ChangeCounter(name=CALCULATIONS_COUNTER, value=start))
+        db.commit()
+    if _counter(db, ARCHIVE_COUNTER).first() is None:
+        db.add(models.ChangeCounter(name=ARCHIVE_COUNTER, value=0))
+        db.commit()
+
+
+def current_version(db: Session) -> int:
+    """Last change version handed out (0 before the first write)."""
+    value = _counter(db).with_entities(models.ChangeCounter.value).scalar()
+    return value or 0
+
+
+def table_state(db: Session) -> tuple[int, int]:
+    """
+    (current version, archive runs) of the calculations table. Every
+    write bumps the first and archiving the second, so together they
+    identify the list, for the price of one primary-key lookup.
+    """
+    values = dict(
+        db.query(models.ChangeCounter.name, models.ChangeCounter.value).filter(
+            models.ChangeCounter.name.in_((CALCULATIONS_COUNTER, ARCHIVE_COUNTER))
+        )
+    )
+    return values.get(CALCULATIONS_COUNTER, 0), values.get(ARCHIVE_COUNTER, 0)
+
+
+def _next_value(db: Session, name: str) -> int:
+    version = db.execute(
+        update(models.ChangeCounter)
+        .where(models.ChangeCounter.name == name)
+        .values(value=models.ChangeCounter.value + 1)
+        .returning(models.ChangeCounter.value)
+    ).scalar()
+    if version is None:
+        ensure_change_counter(db)
+        return _next_value(db, name)
+    return version
+
+
+def _next_version(db: Session) -> int:
+    """
+    Allocate the next change version in the caller's transaction. The
+    counter row stays locked until that transaction ends, so concurrent
+    writers get distinct versions that become visible in order.
+    """
+    return _next_value(db, CALCULATIONS_COUNTER)
+
+
+def record_archived(db: Session) -> None:
+    """Note, in the caller's transaction, that rows were archived away."""
+    _next_value(db, ARCHIVE_COUNTER)
+
+
+def get_changes(
+    db: Session,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    owner_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> list[models.Calculation]:
+    """
+    Rows changed after version `since` (up to and including `until`),
+    oldest change first, including tombstones of deleted rows.
+    since=None returns every row, for a first full sync.
+    """
+    query = db.query(models.Calculation)
+    if since is not None:
+        query = query.filter(models.Calculation.version > since)
+    if until is not None:
+        query = query.filter(models.Calculation.version <= until)
+    if owner_id is not None:
+        query = query.filter(models.Calculation.user_id == owner_id)
+    query = query.order_by(models.Calculation.version, models.Calculation.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def get_change_page(
+    db: Session,
+    since: Optional[int] = None,
+    owner_id: Optional[int] = None,
+    limit: int = 1000,
+) -> tuple[list[models.Calculation], int, bool]:
+    """
+    One page of the change feed: (rows, version to continue from, has_more).
+
+    The watermark is read before the rows and used as their upper bound,
+    so a write committing in between shows up on the next page instead of
+    being skipped. A version is never split across pages.
+    """
+    watermark = current_version(db)
+    rows = get_changes(db, since=since, until=watermark, owner_id=owner_id, limit=limit + 1)
+    if len(rows) <= limit:
+        return rows, max(since or 0, watermark), False
+
+    cut = rows[limit].version
+    page = [r for r in rows[:limit] if r.version != cut]
+    if not page:
+        page = get_changes(db, since=cut - 1, until=cut, owner_id=owner_id)
+    return page, page[-1].version, True
+
+
+def get_change_bound(db: Session, since: int, until: int, limit: int) -> int:
+    """
+    The version at most `limit` changed versions after `since`, capped at
+    `until`: how far one round of the change stream reads.
+    """
+    versions = (
+        db.query(models.Calculation.version)
+        .filter(models.Calculation.version > since, models.Calculation.version <= until)
+        .distinct()
+        .order_by(models.Calculation.version)
+        .limit(limit)
+        .all()
+    )
+    return versions[-1].version if len(versions) == limit else until
+
+
+def get_change_versions(db: Session, since: int, until: int) -> list[dict]:
+    """
+    Summary of each version changed after `since` (up to `until`), oldest
+    first, for the change stream: dicts with version, count, deleted (how
+    many are tombstones), min_id, max_id, job_id (lowest, if any) and
+    user_ids. One statement, so every figure comes from the same snapshot,
+    and cheap for versions that touched thousands of rows.
+    """
+    calc = models.Calculation
+    rows = (
+        db.query(
+            calc.version,
+            calc.user_id,
+            func.count(calc.id).label("count"),
+            func.sum(case((calc.deleted.is_(True), 1), else_=0)).label("deleted"),
+            func.min(calc.id).label("min_id"),
+            func.max(calc.id).label("max_id"),
+            func.min(calc.job_id).label("job_id"),
+        )
+        .filter(calc.version > since, calc.version <= until)
+        .group_by(calc.version, calc.user_id)
+        .order_by(calc.version)
+    )
+    versions: dict[int, dict] = {}
+    for row in rows:
+        summary = versions.get(row.version)
+        if summary is None:
+            versions[row.version] = {
+                "version": row.version,
+                "count": row.count,
+                "deleted": row.deleted,
+                "min_id": row.min_id,
+                "max_id": row.max_id,
+                "job_id": row.job_id,
+                "user_ids": {row.user_id},
+            }
+            continue
+        summary["count"] += row.count
+        summary["deleted"] += row.deleted
+        summary["min_id"] = min(summary["min_id"], row.min_id)
+        summary["max_id"] = max(summary["max_id"], row.max_id)
+        if row.job_id is not None:
+            summary["job_id"] = min(summary["job_id"] or row.job_id, row.job_id)
+        summary["user_ids"].add(row.user_id)
+    return list(versions.values())
+
+
+def get_version_rows(db: Session, versions: list[int]) -> list[models.Calculation]:
+    """The rows stamped with the given versions."""
+    if not versions:
+        return []
+    return db.query(models.Calculation).filter(models.Calculation.version.in_(versions)).all()
+
+
+def max_calculation_id(db: Session) -> int:
+    return db.query(func.max(models.Calculation.id)).scalar() or 0
 
 
 def create_calculation(
@@ -98,10 +323,12 @@ def create_calculation(
         type=calc_in.type,
         result=result,
         user_id=owner_id,
+        version=_next_version(db),
     )
     db.add(calc)
     db.commit()
     db.refresh(calc)
+    broker.notify()
     return calc
 
 
@@ -124,14 +351,305 @@ def update_calculation(
             )
         calc.result = _compute_result(calc.a, calc.b, calc.type)
 
+    calc.version = _next_version(db)
     db.commit()
     db.refresh(calc)
+    broker.notify()
     return calc
 
 
 def delete_calculation(db: Session, calc: models.Calculation) -> None:
-    db.delete(calc)
+    """Soft delete: keep the row as a tombstone so sync clients see it go."""
+    calc.deleted = True
+    calc.version = _next_version(db)
+    db.commit()
+    broker.notify()
+
+
+# ---------------- BULK HELPERS ---------------- #
+
+
+def _bulk_filters(filter_in: schemas.CalculationFilter) -> list:
+    filters = [models.Calculation.deleted.is_(False)]
+    if filter_in.user_id is not None:
+        filters.append(models.Calculation.user_id == filter_in.user_id)
+    if filter_in.type is not None:
+        filters.append(models.Calculation.type == filter_in.type)
+    if filter_in.id_lt is not None:
+        filters.append(models.Calculation.id < filter_in.id_lt)
+    return filters
+
+
+def _bulk_chunks(db: Session, filters: list):
+    """Yield the ids of matching rows, BULK_CHUNK_SIZE at a time."""
+    last_id = 0
+    while True:
+        ids = [
+            row.id
+            for row in db.query(models.Calculation.id)
+            .filter(*filters, models.Calculation.id > last_id)
+            .order_by(models.Calculation.id)
+            .limit(BULK_CHUNK_SIZE)
+        ]
+        if not ids:
+            return
+        last_id = ids[-1]
+        yield ids
+
+
+def bulk_update_calculations(
+    db: Session,
+    filter_in: schemas.CalculationFilter,
+    data: schemas.CalculationUpdate,
+) -> int:
+    """
+    Apply the same field changes to every matching calculation with one
+    UPDATE per chunk, recomputing result in SQL. Returns the row count.
+    """
+    changes = data.model_dump(exclude_unset=True)
+    if not changes:
+        return 0
+    nulls = sorted(field for field, value in changes.items() if value is None)
+    if nulls:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{', '.join(nulls)} cannot be null",
+        )
+    if "type" in changes and changes["type"] not in VALID_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid calculation type",
+        )
+
+    filters = _bulk_filters(filter_in)
+    values = dict(changes)
+
+    if any(k in changes for k in ("a", "b", "type")):
+        a = literal(changes["a"]) if "a" in changes else models.Calculation.a
+        b = literal(changes["b"]) if "b" in changes else models.Calculation.b
+        type_ = literal(changes["type"]) if "type" in changes else models.Calculation.type
+
+        zero_divisions = (
+            db.query(func.count(models.Calculation.id))
+            .filter(*filters, type_.in_(DIVISION_TYPES), b == 0)
+            .scalar()
+        )
+        if zero_divisions:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Division by zero",
+            )
+
+        values["result"] = case(
+            *[(type_ == name, op(a, b)) for name, op in SQL_OPERATIONS.items()],
+            else_=models.Calculation.result,
+        )
+
+    affected = 0
+    for ids in _bulk_chunks(db, filters):
+        version = _next_version(db)
+        db.execute(
+            update(models.Calculation)
+            .where(models.Calculation.id.in_(ids))
+            .values(version=version, **values)
+        )
+        db.commit()
+        affected += len(ids)
+        broker.notify()
+    return affected
+
+
+def bulk_delete_calculations(db: Session, filter_in: schemas.CalculationFilter) -> int:
+    """Soft delete every matching calculation, one UPDATE per chunk."""
+    filters = _bulk_filters(filter_in)
+    affected = 0
+    for ids in _bulk_chunks(db, filters):
+        version = _next_version(db)
+        db.execute(
+            update(models.Calculation)
+            .where(models.Calculation.id.in_(ids))
+            .values(deleted=True, version=version)
+        )
+        db.commit()
+        affected += len(ids)
+        broker.notify()
+    return affected
+
+
+# ---------------- JOB HELPERS ---------------- #
+
+JOB_ACTIVE_STATUSES = ("pending", "running")
+
+
+def create_job(
+    db: Session,
+    job_in: schemas.CalculationJobCreate,
+    owner_id: Optional[int] = None,
+) -> models.CalculationJob:
+    if owner_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="owner_id is required for job creation",
+        )
+
+    if any(item.type not in VALID_TYPES for item in job_in.items):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid calculation type",
+        )
+
+    # The workload is kept with the job so it can be resumed after a restart
+    payload = json.dumps([[item.a, item.b, item.type] for item in job_in.items])
+    job = models.CalculationJob(
+        user_id=owner_id,
+        status="pending",
+        total=len(job_in.items),
+        payload=payload,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_job(db: Session, job_id: int) -> Optional[models.CalculationJob]:
+    return db.query(models.CalculationJob).filter(models.CalculationJob.id == job_id).first()
+
+
+def get_active_jobs(
+    db: Session, statuses: tuple = JOB_ACTIVE_STATUSES
+) -> list[models.CalculationJob]:
+    return (
+        db.query(models.CalculationJob)
+        .filter(models.CalculationJob.status.in_(statuses))
+        .order_by(models.CalculationJob.id)
+        .all()
+    )
+
+
+def claim_job(db: Session, job_id: int, resume: bool = False) -> bool:
+    """
+    Mark a pending job running, in one conditional UPDATE so only one
+    caller wins. With resume=True a job already marked running (left over
+    from a stopped process) can be claimed too.
+    """
+    statuses = JOB_ACTIVE_STATUSES if resume else ("pending",)
+    claimed = db.execute(
+        update(models.CalculationJob)
+        .where(
+            models.CalculationJob.id == job_id,
+            models.CalculationJob.status.in_(statuses),
+        )
+        .values(status="running")
+    ).rowcount
+    db.commit()
+    return claimed == 1
+
+
+def get_job_results(
+    db: Session, job_id: int, after_id: int = 0, limit: int = 1000
+) -> list[models.Calculation]:
+    return (
+        _live_calculations(db)
+        .filter(models.Calculation.job_id == job_id, models.Calculation.id > after_id)
+        .order_by(models.Calculation.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def cancel_job(db: Session, job: models.CalculationJob) -> models.CalculationJob:
+    """
+    Cancel a pending or running job. Like claim_job this is one
+    conditional UPDATE, so a job that finishes at the same moment is
+    either cancelled or reported as already finished, never both.
+    """
+    cancelled = db.execute(
+        update(models.CalculationJob)
+        .where(
+            models.CalculationJob.id == job.id,
+            models.CalculationJob.status.in_(JOB_ACTIVE_STATUSES),
+        )
+        .values(status="cancelled", finished_at=datetime.now(timezone.utc))
+    ).rowcount
     db.commit()
+    db.refresh(job)
+    if not cancelled:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job is already {job.status}",
+        )
+    return job
+
 
+def save_job_chunk(
+    db: Session,
+    job: models.CalculationJob,
+    items: list,
+    results: list[Optional[float]],
+) -> bool:
+    """
+    Bulk insert one computed chunk and advance the job's progress in the
+    same transaction, so a restarted job never saves a chunk twice.
+    Items whose result is None (e.g. division by zero) are counted as failed.
+    Returns False, saving nothing, if the job is no longer running
+    (cancelled since the chunk was computed).
+    """
+    rows = [
+        {
+            "a": a,
+            "b": b,
+            "type": type_,
+            "result": result,
+            "user_id": job.user_id,
+            "job_id": job.id,
+        }
+        for (a, b, type_), result in zip(items, results)
+        if result is not None
+    ]
+    # Progress first: the conditional UPDATE also locks the job row, so a
+    # cancel either lands before this chunk or waits for it
+    saved = db.execute(
+        update(models.CalculationJob)
+        .where(
+            models.CalculationJob.id == job.id,
+            models.CalculationJob.status == "running",
+        )
+        .values(
+            processed=models.CalculationJob.processed + len(items),
+            failed=models.CalculationJob.failed + len(items) - len(rows),
+        )
+    ).rowcount
+    if not saved:
+        db.rollback()
+        return False
+    if rows:
+        version = _next_version(db)
+        db.execute(insert(models.Calculation), [dict(row, version=version) for row in rows])
+    db.commit()
+    if rows:
+        broker.notify()
+    return True
 
 
+def finish_job(
+    db: Session, job: models.CalculationJob, error: Optional[str] = None
+) -> bool:
+    """
+    Mark a running job done (or failed, with an error). Returns False if
+    it was cancelled meanwhile, which then stands.
+    """
+    finished = db.execute(
+        update(models.CalculationJob)
+        .where(
+            models.CalculationJob.id == job.id,
+            models.CalculationJob.status == "running",
+        )
+        .values(
+            status="failed" if error else "done",
+            error=error,
+            finished_at=datetime.now(timezone.utc),
+        )
+    ).rowcount
+    db.commit()
+    return finished == 1
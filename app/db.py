@@ -1,6 +1,7 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.sql.functions import FunctionElement
 
 # Default to SQLite for local dev. For CI / Docker, we'll override DATABASE_URL.
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
@@ -22,3 +23,54 @@ def get_db():
     finally:
         db.close()
 
+
+
+def add_missing_columns(bind) -> None:
+    """
+    Add model columns that an existing database does not have yet.
+
+    create_all() only creates missing tables, so databases made before a
+    column was added (like the local app.db) would otherwise fail on every
+    query. New columns must be nullable or have a constant server default.
+    On SQLite, columns defaulting to a function such as now() cannot get
+    that default on existing rows, so their NULLs are backfilled instead.
+    """
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(dialect=bind.dialect)
+                )
+                default = column.server_default.arg if column.server_default is not None else None
+                if isinstance(default, FunctionElement) and bind.dialect.name == "sqlite":
+                    # SQLite cannot add a column with a non-constant default
+                    # such as now(); existing rows are left NULL instead.
+                    default = None
+                if default is not None:
+                    if not isinstance(default, str):
+                        default = default.compile(dialect=bind.dialect)
+                    ddl += f" DEFAULT {default}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+            if bind.dialect.name == "sqlite":
+                _backfill_function_defaults(conn, table)
+
+
+def _backfill_function_defaults(conn, table) -> None:
+    # Also covers databases whose column was added (and left NULL) by an
+    # earlier start; a no-op once no NULLs are left
+    for column in table.columns:
+        default = column.server_default.arg if column.server_default is not None else None
+        if isinstance(default, FunctionElement):
+            conn.execute(
+                table.update().where(column.is_(None)).values({column.name: default})
+            )
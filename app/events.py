@@ -0,0 +1,217 @@
+# app/events.py
+"""
+Per-process pub/sub broker for calculation changes.
+
+Writes are not published where they happen: with several server worker
+processes, a stream connection would only see the writes of the worker
+serving it. Instead every process runs a ChangeTailer (app/changefeed.py)
+that follows the version column of the calculations table and publishes
+each committed version here. crud calls notify() after a write so the
+local tailer picks it up straight away; writes from other processes are
+seen on its next poll. Event ids are change versions, so they mean the
+same thing in every process and across restarts.
+
+Each open /calculations/stream connection holds a Subscription that
+receives the events for its user (or for everyone, when no user is
+given). Subscriptions live on the event loop that serves the stream,
+while the tailer runs in a thread, so events are handed over with
+call_soon_threadsafe. Every subscriber gets a bounded queue; one that
+falls behind is dropped instead of letting memory grow, and can resume
+from the replay buffer using the last event id it saw.
+
+Streams never end on their own, and uvicorn waits for every open
+connection before it runs the app's shutdown. close() ends them all; it
+is called as soon as the server is told to stop (close_on_exit_signals),
+and clients reconnect to another worker with Last-Event-ID.
+"""
+import asyncio
+import json
+import signal
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+SUBSCRIBER_QUEUE_SIZE = 100
+REPLAY_BUFFER_SIZE = 1000
+HEARTBEAT_SECONDS = 15.0
+
+
+@dataclass(frozen=True)
+class Event:
+    id: int  # change version
+    type: str  # "created", "updated", "deleted", "bulk", "reset"
+    user_ids: frozenset
+    data: dict
+
+    def encode(self) -> bytes:
+        """Format the event as a Server-Sent Events frame."""
+        return (
+            f"id: {self.id}\n"
+            f"event: {self.type}\n"
+            f"data: {json.dumps(self.data)}\n\n"
+        ).encode("utf-8")
+
+
+class Subscription:
+    def __init__(self, user_id: Optional[int], maxsize: int, after: int = 0):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        # Replayed events to send before anything from the queue
+        self.backlog: list[Event] = []
+        # Events up to this id were already seen by the client
+        self.after = after
+        self.dropped = False
+        self.closed = False
+
+    def wants(self, event: Event) -> bool:
+        return event.id > self.after and (
+            self.user_id is None or self.user_id in event.user_ids
+        )
+
+    def _offer(self, event: Event) -> None:
+        # Always runs on self.loop
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer: throw away what it has not read and tell the
+            # stream to close. The client reconnects with Last-Event-ID.
+            self.dropped = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def _close(self) -> None:
+        # Always runs on self.loop; ends the stream with no "dropped" frame
+        if self.closed or self.dropped:
+            return
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class Broker:
+    def __init__(
+        self,
+        queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+        buffer_size: int = REPLAY_BUFFER_SIZE,
+    ):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers: set[Subscription] = set()
+        self._buffer: deque[Event] = deque(maxlen=buffer_size)
+        self._last_id = 0
+        # Every event after this id is still in the buffer
+        self._floor = 0
+        # Set by notify(), waited on by the tailer
+        self.changed = threading.Event()
+        self.closing = False
+
+    def notify(self) -> None:
+        """Tell the tailer there is a new committed change to publish."""
+        self.changed.set()
+
+    def open(self) -> None:
+        """Accept streams again after close() (at server startup)."""
+        with self._lock:
+            self.closing = False
+
+    def close(self) -> None:
+        """End every open stream, and any opened from now on."""
+        with self._lock:
+            self.closing = True
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.loop.call_soon_threadsafe(sub._close)
+            except RuntimeError:
+                self.unsubscribe(sub)
+
+    def start_at(self, version: int) -> None:
+        """Called by the tailer before its first event: nothing before
+        `version` can be replayed."""
+        with self._lock:
+            self._buffer.clear()
+            self._last_id = self._floor = version
+
+    def publish(self, event: Event) -> Event:
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._floor = self._buffer[0].id
+            self._buffer.append(event)
+            self._last_id = event.id
+            subscribers = [s for s in self._subscribers if s.wants(event)]
+
+        for sub in subscribers:
+            try:
+                sub.loop.call_soon_threadsafe(sub._offer, event)
+            except RuntimeError:
+                # The subscriber's loop is gone
+                self.unsubscribe(sub)
+        return event
+
+    def subscribe(
+        self,
+        user_id: Optional[int] = None,
+        last_event_id: Optional[int] = None,
+    ) -> Subscription:
+        """
+        Register a subscriber on the running event loop.
+
+        With last_event_id, events published after it are queued in
+        sub.backlog. If they are no longer in the replay buffer a single
+        "reset" event is queued instead, telling the client to refetch.
+        An id this process has not reached yet (another worker's tailer
+        was ahead) just means waiting for the events after it.
+        """
+        with self._lock:
+            if last_event_id is None or last_event_id >= self._last_id:
+                sub = Subscription(user_id, self.queue_size, after=last_event_id or 0)
+            else:
+                sub = Subscription(user_id, self.queue_size)
+                if last_event_id < self._floor:
+                    sub.backlog.append(
+                        Event(id=self._last_id, type="reset", user_ids=frozenset(), data={})
+                    )
+                else:
+                    sub.backlog.extend(
+                        e for e in self._buffer if e.id > last_event_id and sub.wants(e)
+                    )
+            if self.closing:
+                sub._close()
+            else:
+                self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            self._subscribers.discard(sub)
+
+
+def close_on_exit_signals(broker: Broker, loop: asyncio.AbstractEventLoop) -> None:
+    """
+    Close `broker` when the process gets SIGTERM or SIGINT, then let the
+    handler already installed (uvicorn's) carry on with its shutdown.
+    Call it from the app's startup, once the server has set its handlers;
+    it does nothing outside the main thread (e.g. under the test client).
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            # Not close() itself: the broker lock may be held by the code
+            # this signal interrupted
+            loop.call_soon_threadsafe(broker.close)
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+
+broker = Broker()
@@ -0,0 +1,250 @@
+# app/jobs.py
+"""
+Background runner for batch calculation jobs.
+
+A job is split into chunks. Chunks are computed in a process pool and
+saved in order, one transaction per chunk, by a single dispatcher thread.
+All state lives in the calculation_jobs table, so a job interrupted by a
+restart is picked up again from its last saved chunk (resume_active()).
+On shutdown the running job stops between chunks and stays "running",
+so the next start resumes it rather than marking it failed.
+
+With several server worker processes, start() lets only the process
+holding the job lock run jobs. The others just store new jobs, and the
+lock holder finds them by polling the table.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process runs its own jobs
+    fcntl = None
+
+from . import crud
+from .db import DATABASE_URL, SessionLocal
+from .operations import compute_chunk
+from .workers import available_cpus
+
+logger = logging.getLogger(__name__)
+
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "10000"))
+# 0 computes in the dispatcher thread instead of a process pool
+JOB_WORKERS = int(os.getenv("JOB_WORKERS") or available_cpus())
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# One lock per database, so unrelated servers on a host do not share it
+JOB_LOCK_PATH = os.getenv(
+    "JOB_LOCK_PATH",
+    os.path.join(
+        tempfile.gettempdir(),
+        "calc-jobs-{}.lock".format(hashlib.sha1(DATABASE_URL.encode()).hexdigest()[:12]),
+    ),
+)
+
+
+class _InlineExecutor(Executor):
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class JobRunner:
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        workers: int = JOB_WORKERS,
+        chunk_size: int = JOB_CHUNK_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._dispatcher: Optional[ThreadPoolExecutor] = None
+        self._pool: Optional[Executor] = None
+        self._queued: set[int] = set()
+        self._stopping = threading.Event()
+        self._lock_file = None
+        # None until start(): run whatever is submitted in this process
+        self.leader: Optional[bool] = None
+
+    def _start(self) -> None:
+        # Pools are created on first use, not at import time
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="calc-jobs"
+                )
+                if self.workers > 0:
+                    # Spawned, not forked: a forked child would inherit this
+                    # process's database connections and threads
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                else:
+                    self._pool = _InlineExecutor()
+
+    def start(self) -> None:
+        """
+        Called at server startup, in every worker process. Whichever
+        process gets the job lock resumes interrupted jobs and then polls
+        for jobs stored by the other processes.
+        """
+        if fcntl is not None:
+            lock_file = open(JOB_LOCK_PATH, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                self.leader = False
+                return
+            self._lock_file = lock_file
+
+        self.leader = True
+        self._stopping.clear()
+        threading.Thread(target=self._poll, name="calc-jobs-poll", daemon=True).start()
+
+    def _poll(self) -> None:
+        resume = True
+        while not self._stopping.is_set():
+            try:
+                self.resume_active(include_running=resume)
+                resume = False
+            except Exception:
+                logger.exception("Polling for calculation jobs failed")
+            self._stopping.wait(JOB_POLL_SECONDS)
+
+    def submit(self, job_id: int, resume: bool = False) -> Optional[Future]:
+        if self.leader is False or self._stopping.is_set():
+            # Another process runs jobs and will find this one when it
+            # polls; after shutdown, the next start picks it up
+            return None
+        with self._lock:
+            if job_id in self._queued:
+                return None
+            self._queued.add(job_id)
+        self._start()
+        return self._dispatcher.submit(self._run_queued, job_id, resume)
+
+    def _run_queued(self, job_id: int, resume: bool) -> None:
+        try:
+            self.run(job_id, resume=resume)
+        finally:
+            with self._lock:
+                self._queued.discard(job_id)
+
+    def resume_active(self, include_running: bool = True) -> int:
+        """
+        Queue stored jobs that have not finished; returns how many.
+        Jobs marked running are only taken with include_running, i.e. at
+        startup, when nothing in this process can be running them.
+        """
+        statuses = crud.JOB_ACTIVE_STATUSES if include_running else ("pending",)
+        db = self.session_factory()
+        try:
+            job_ids = [job.id for job in crud.get_active_jobs(db, statuses)]
+        finally:
+            db.close()
+        for job_id in job_ids:
+            self.submit(job_id, resume=include_running)
+        return len(job_ids)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop taking jobs. The job being run stops after its current chunk
+        and is left running, to be resumed; queued jobs stay pending. The
+        process pool is only shut down once the dispatcher has exited, so
+        the job never sees it disappear mid-chunk.
+        """
+        self._stopping.set()
+        with self._lock:
+            dispatcher, pool = self._dispatcher, self._pool
+            self._dispatcher = self._pool = None
+            lock_file, self._lock_file = self._lock_file, None
+        if dispatcher is not None:
+            dispatcher.shutdown(wait=False, cancel_futures=True)
+
+            def _close_pool():
+                dispatcher.shutdown(wait=True)
+                pool.shutdown(wait=True, cancel_futures=True)
+
+            if wait:
+                _close_pool()
+            else:
+                threading.Thread(
+                    target=_close_pool, name="calc-jobs-shutdown", daemon=True
+                ).start()
+        if lock_file is not None:
+            lock_file.close()
+
+    def run(self, job_id: int, resume: bool = False) -> None:
+        """
+        Process a job to completion, starting after its saved progress.
+        Pending jobs are claimed atomically, so two processes never both
+        start one; running jobs are only taken over when resuming.
+        """
+        self._start()
+        # Kept for the whole run: shutdown() drops self._pool straight away
+        pool = self._pool
+        db = self.session_factory()
+        try:
+            if not crud.claim_job(db, job_id, resume=resume):
+                return
+            job = crud.get_job(db, job_id)
+
+            items = json.loads(job.payload)
+            chunks = (
+                items[i:i + self.chunk_size]
+                for i in range(job.processed, len(items), self.chunk_size)
+            )
+            try:
+                for chunk, results in self._compute(pool, chunks):
+                    if self._stopping.is_set():
+                        # Left running with its progress saved; resumed
+                        # by whichever process runs jobs next
+                        return
+                    if not crud.save_job_chunk(db, job, chunk, results):
+                        # Cancelled; chunks already saved are kept
+                        return
+            except Exception as e:
+                if self._stopping.is_set():
+                    return
+                logger.exception("Calculation job %s failed", job_id)
+                db.rollback()
+                crud.finish_job(db, job, error=str(e) or type(e).__name__)
+                return
+            crud.finish_job(db, job)
+        finally:
+            db.close()
+
+    def _compute(self, pool: Executor, chunks):
+        """
+        Yield (chunk, results) in order, keeping a couple of chunks per
+        worker in flight so the pool stays busy without computing far
+        ahead of a cancellation.
+        """
+        in_flight: deque = deque()
+        window = max(self.workers, 1) * 2
+        for chunk in chunks:
+            in_flight.append((chunk, pool.submit(compute_chunk, chunk)))
+            if len(in_flight) >= window:
+                chunk, future = in_flight.popleft()
+                yield chunk, future.result()
+        while in_flight:
+            chunk, future = in_flight.popleft()
+            yield chunk, future.result()
+
+
+runner = JobRunner()
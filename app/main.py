@@ -1,23 +1,53 @@
 # app/main.py
+import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI
 from fastapi.responses import HTMLResponse
 
-from app.db import Base, engine
+from app.changefeed import tailer
+from app.crud import ensure_change_counter
+from app.db import Base, SessionLocal, engine, add_missing_columns
+from app.events import broker, close_on_exit_signals
+from app.jobs import runner
 from app.routers import users, calculations
 
 # -----------------------
 # Database setup
 # -----------------------
 Base.metadata.create_all(bind=engine)
+add_missing_columns(engine)
+with SessionLocal() as _db:
+    ensure_change_counter(_db)
 
-app = FastAPI(title="FastAPI User & Calculation App")
+
+# -----------------------
+# Background jobs and change stream
+# -----------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Resume batch jobs interrupted by the last shutdown (in one process)
+    runner.start()
+    # Every process publishes every committed change to its own streams
+    tailer.start()
+    # Open streams would otherwise hold up the shutdown below
+    broker.open()
+    close_on_exit_signals(broker, asyncio.get_running_loop())
+    yield
+    broker.close()
+    tailer.stop()
+    runner.shutdown(wait=False)
+
+
+app = FastAPI(title="FastAPI User & Calculation App", lifespan=lifespan)
 
 # -----------------------
 # Routers
 # -----------------------
 app.include_router(users.router)
 app.include_router(calculations.router)
+# Cached reads are dropped on writes from any worker, not only this one
+tailer.listeners.append(calculations.reads.invalidate)
 
 # -----------------------
 # Frontend file loader
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float
-from sqlalchemy.sql import func
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, Float, Text
+from sqlalchemy.sql import false, func
 from .db import Base
 
 
@@ -22,4 +22,37 @@ class Calculation(Base):
     type = Column(String, nullable=False)  # "add", "sub", "mul", "div"
     result = Column(Float, nullable=True)
     user_id = Column(Integer, nullable=False)
+    # Change tracking for sync clients: every write stamps the row with the
+    # next table-wide version, and deletes only set the tombstone flag.
+    version = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+    deleted = Column(Boolean, nullable=False, default=False, server_default=false())
+    # Set for rows produced by a batch job
+    job_id = Column(Integer, nullable=True, index=True)
+    # Range queries on this index keep reads fast as history grows; rows
+    # older than the hot window are moved out by app/archive.py
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+class ChangeCounter(Base):
+    # Allocates change versions. Bumping the row inside a write transaction
+    # locks it until commit, so versions commit in the order they are handed out.
+    __tablename__ = "change_counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+class CalculationJob(Base):
+    __tablename__ = "calculation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, index=True)  # "pending", "running", "done", "failed", "cancelled"
+    total = Column(Integer, nullable=False)
+    processed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    payload = Column(Text, nullable=False)  # JSON list of [a, b, type]
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
 
@@ -0,0 +1,67 @@
+# app/operations.py
+"""
+Calculation operators.
+
+Plain functions with no FastAPI or database access, so they can run in
+the job worker processes (see app/jobs.py) as well as in crud.
+SQL_OPERATIONS holds the same operators as SQL expressions, for bulk
+updates that recompute results inside the UPDATE statement.
+"""
+import operator
+from typing import Optional
+
+from sqlalchemy import func
+
+
+def _divide(a: float, b: float) -> float:
+    if b == 0:
+        raise ZeroDivisionError("Division by zero")
+    return a / b
+
+
+DIVISION_TYPES = frozenset({"div", "divide"})
+
+# Calculation type -> function(a, b)
+OPERATIONS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "subtract": operator.sub,
+    "mul": operator.mul,
+    "multiply": operator.mul,
+    "div": _divide,
+    "divide": _divide,
+}
+
+# Calculation type -> function(a, b) building the SQL expression.
+# Division by zero is rejected before the UPDATE runs; NULLIF still keeps
+# the database from raising if it evaluates (or constant-folds) x / 0.
+SQL_OPERATIONS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "subtract": operator.sub,
+    "mul": operator.mul,
+    "multiply": operator.mul,
+    "div": lambda a, b: a / func.nullif(b, 0),
+    "divide": lambda a, b: a / func.nullif(b, 0),
+}
+assert SQL_OPERATIONS.keys() == OPERATIONS.keys()
+
+
+def compute(a: float, b: float, type_: str) -> float:
+    """Raises ValueError for an unknown type and ZeroDivisionError for x/0."""
+    try:
+        op = OPERATIONS[type_]
+    except KeyError:
+        raise ValueError("Invalid calculation type")
+    return op(a, b)
+
+
+def compute_chunk(items: list[tuple[float, float, str]]) -> list[Optional[float]]:
+    """Compute (a, b, type) rows; rows that cannot be computed give None."""
+    results = []
+    for a, b, type_ in items:
+        try:
+            results.append(compute(a, b, type_))
+        except (ValueError, ZeroDivisionError):
+            results.append(None)
+    return results
@@ -1,13 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+import os
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from sqlalchemy.orm import Session
 
 
-from app import schemas, crud
+from app import schemas, crud, events, jobs
 from app.db import get_db
+from app.singleflight import SingleFlight
 from fastapi import Query
 
 router = APIRouter(prefix="/calculations", tags=["calculations"])
 
+# Identical concurrent GETs share one query. With READ_STALE_SECONDS > 0 a
+# finished response is also reused for that long (writes through this
+# router clear it).
+reads = SingleFlight(stale_seconds=float(os.getenv("READ_STALE_SECONDS", "0")))
+
+_calculation_list = TypeAdapter(list[schemas.CalculationRead])
+
 
 @router.post("/", response_model=schemas.CalculationRead, status_code=status.HTTP_201_CREATED)
 def create(
@@ -19,20 +34,225 @@ def create(
         calc = crud.create_calculation(db, calc_in, owner_id=owner_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    reads.invalidate()
     return calc
 
 
+def _etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match already names this ETag."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag in tags
+
+
+def _read_key(request: Request) -> tuple:
+    # Same route, same parameters and same caller -> same response
+    return (
+        request.url.path,
+        tuple(sorted(request.query_params.multi_items())),
+        request.headers.get("authorization"),
+    )
+
+
+def _cached_response(request: Request, result) -> Response:
+    """Build the response for a coalesced (etag, body) read result."""
+    etag, body = result
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
 @router.get("/", response_model=list[schemas.CalculationRead])
-def browse(db: Session = Depends(get_db)):
-    return crud.get_calculations(db)
+def browse(
+    request: Request,
+    created_from: Optional[datetime] = Query(None),
+    created_to: Optional[datetime] = Query(None),
+    db: Session = Depends(get_db),
+):
+    def list_etag() -> str:
+        # Every write bumps the change version and every archive run the
+        # archive counter, so together they identify the list
+        version, archived = crud.table_state(db)
+        return f'"calcs-v{version}-a{archived}"'
+
+    # Answer a matching If-None-Match before loading any rows
+    etag = list_etag()
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    def load():
+        etag = list_etag()
+        rows = crud.get_calculations(db, created_from=created_from, created_to=created_to)
+        return etag, _calculation_list.dump_json(rows)
+
+    return _cached_response(request, reads.do(_read_key(request), load))
+
+
+@router.delete("", response_model=schemas.BulkResult)
+def bulk_delete(
+    user_id: Optional[int] = Query(None),
+    type: Optional[str] = Query(None),
+    id_lt: Optional[int] = Query(None),
+    db: Session = Depends(get_db),
+):
+    """Delete every calculation matching the filters (at least one is required)."""
+    filter_in = schemas.CalculationFilter(user_id=user_id, type=type, id_lt=id_lt)
+    if not filter_in.model_dump(exclude_none=True):
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    affected = crud.bulk_delete_calculations(db, filter_in)
+    reads.invalidate()
+    return {"affected": affected}
+
+
+@router.patch("/bulk", response_model=schemas.BulkResult)
+def bulk_update(data: schemas.CalculationBulkUpdate, db: Session = Depends(get_db)):
+    """Apply the same changes to every calculation matching `filter` (at least one is required)."""
+    if not data.filter.model_dump(exclude_none=True):
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    affected = crud.bulk_update_calculations(db, data.filter, data.changes)
+    reads.invalidate()
+    return {"affected": affected}
+
+
+@router.get("/changes", response_model=schemas.CalculationChanges)
+def changes(
+    since: Optional[int] = Query(None, ge=0),
+    owner_id: Optional[int] = Query(None, alias="owner_id"),
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+):
+    """
+    Incremental change feed.
+
+    Omit `since` for the first sync, then pass back the returned `version`
+    to get only what changed after it. Deleted rows are returned with
+    deleted=true.
+    """
+    rows, version, has_more = crud.get_change_page(
+        db, since=since, owner_id=owner_id, limit=limit
+    )
+    return {"version": version, "has_more": has_more, "changes": rows}
+
+
+async def _event_stream(request: Request, sub: events.Subscription):
+    try:
+        # Tell EventSource how long to wait before reconnecting
+        yield b"retry: 3000\n\n"
+        for event in sub.backlog:
+            yield event.encode()
+
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    sub.queue.get(), timeout=events.HEARTBEAT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield b": heartbeat\n\n"
+                continue
+
+            if event is None:
+                if sub.dropped:
+                    # Dropped for falling behind; the client resumes from
+                    # its last event id on reconnect
+                    yield b"event: dropped\ndata: {}\n\n"
+                # else the server is shutting down; the client reconnects
+                # to another worker
+                break
+            yield event.encode()
+    finally:
+        events.broker.unsubscribe(sub)
+
+
+@router.get("/stream")
+async def stream(
+    request: Request,
+    owner_id: Optional[int] = Query(None, alias="owner_id"),
+    last_event_id: Optional[int] = Query(None),
+    last_event_id_header: Optional[int] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    Server-Sent Events feed of calculation changes.
+
+    Events are "created", "updated" and "deleted" (data is the calculation,
+    or its id and user_id for deletes), and "bulk" for a change to many
+    rows at once. Event ids are change versions, valid on any server
+    process. "reset" means the client missed more than the server kept and
+    should refetch the list.
+    """
+    resume_from = last_event_id_header if last_event_id_header is not None else last_event_id
+    sub = events.broker.subscribe(user_id=owner_id, last_event_id=resume_from)
+    return StreamingResponse(
+        _event_stream(request, sub),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post(
+    "/jobs",
+    response_model=schemas.CalculationJobRead,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def create_job(
+    job_in: schemas.CalculationJobCreate,
+    db: Session = Depends(get_db),
+    owner_id: int = Query(None, alias="owner_id"),
+):
+    """Queue a batch of calculations and return the job right away."""
+    job = crud.create_job(db, job_in, owner_id=owner_id)
+    jobs.runner.submit(job.id)
+    return job
+
+
+def _get_job_or_404(db: Session, job_id: int):
+    job = crud.get_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/jobs/{job_id}", response_model=schemas.CalculationJobRead)
+def read_job(job_id: int, db: Session = Depends(get_db)):
+    return _get_job_or_404(db, job_id)
+
+
+@router.post("/jobs/{job_id}/cancel", response_model=schemas.CalculationJobRead)
+def cancel_job(job_id: int, db: Session = Depends(get_db)):
+    # Chunks already saved are kept
+    return crud.cancel_job(db, _get_job_or_404(db, job_id))
+
+
+@router.get("/jobs/{job_id}/results", response_model=list[schemas.CalculationRead])
+def job_results(
+    job_id: int,
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+):
+    """Saved rows of a job, by id. Pass the last id back as after_id for the next page."""
+    _get_job_or_404(db, job_id)
+    return crud.get_job_results(db, job_id, after_id=after_id, limit=limit)
 
 
 @router.get("/{calc_id}", response_model=schemas.CalculationRead)
-def read(calc_id: int, db: Session = Depends(get_db)):
-    calc = crud.get_calculation(db, calc_id)
-    if not calc:
+def read(calc_id: int, request: Request, db: Session = Depends(get_db)):
+    def load():
+        calc = crud.get_calculation(db, calc_id)
+        if not calc:
+            return None
+        body = schemas.CalculationRead.model_validate(calc).model_dump_json()
+        return f'"calc-{calc.id}-v{calc.version}"', body
+
+    result = reads.do(_read_key(request), load)
+    if result is None:
         raise HTTPException(status_code=404, detail="Calculation not found")
-    return calc
+    return _cached_response(request, result)
 
 
 @router.put("/{calc_id}", response_model=schemas.CalculationRead)
@@ -41,6 +261,7 @@ def update(calc_id: int, data: schemas.CalculationUpdate, db: Session = Depends(
     if not calc:
         raise HTTPException(status_code=404, detail="Calculation not found")
     updated = crud.update_calculation(db, calc, data)
+    reads.invalidate()
     return updated
 
 
@@ -50,5 +271,6 @@ def delete(calc_id: int, db: Session = Depends(get_db)):
     if not calc:
         raise HTTPException(status_code=404, detail="Calculation not found")
     crud.delete_calculation(db, calc)
+    reads.invalidate()
     return {"detail": "Calculation deleted"}
 
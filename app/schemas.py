@@ -1,4 +1,5 @@
 # app/schemas.py
+from datetime import datetime
 from typing import Optional
 
 from pydantic import BaseModel, EmailStr, Field
@@ -64,6 +65,57 @@ class CalculationRead(CalculationBase):
     id: int
     result: float
     user_id: int
+    version: int = 0
+    created_at: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
 
+
+class CalculationFilter(BaseModel):
+    # Selects rows for bulk operations; unset fields match everything
+    user_id: Optional[int] = None
+    type: Optional[str] = None
+    id_lt: Optional[int] = None
+
+
+class CalculationBulkUpdate(BaseModel):
+    filter: CalculationFilter
+    changes: CalculationUpdate
+
+
+class BulkResult(BaseModel):
+    affected: int
+
+
+class CalculationChange(CalculationRead):
+    # A changed row; deleted rows come back as tombstones
+    deleted: bool = False
+
+
+class CalculationChanges(BaseModel):
+    # Pass `version` back as `since` to get the next batch
+    version: int
+    has_more: bool
+    changes: list[CalculationChange]
+
+
+
+# =======================
+# Calculation Job Schemas
+# =======================
+
+class CalculationJobCreate(BaseModel):
+    # A batch workload; rows are computed and saved in the background
+    items: list[CalculationBase] = Field(min_length=1)
+
+
+class CalculationJobRead(BaseModel):
+    id: int
+    user_id: int
+    status: str  # "pending", "running", "done", "failed", "cancelled"
+    total: int
+    processed: int
+    failed: int
+    error: Optional[str] = None
+
+    model_config = ConfigDict(from_attributes=True)
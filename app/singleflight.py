@@ -0,0 +1,99 @@
+# app/singleflight.py
+"""
+Request coalescing for hot reads.
+
+When many identical reads arrive together (a dashboard refresh, clients
+reconnecting after a deploy), only the first one runs its query; the
+others wait for it and get the same result. Optionally a finished result
+is reused for `stale_seconds`, and while it is being refreshed readers
+keep getting the old value instead of queueing behind the refresh, for
+up to another `stale_seconds`; after that they wait for the refresh.
+
+invalidate() starts a new generation: calls already running when it is
+called are neither joined by later readers nor remembered, since they
+may have read the data from before the write.
+"""
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+MAX_RECENT = 1024
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self, stale_seconds: float = 0.0):
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+        # key -> (fresh_until, value), only used when stale_seconds > 0
+        self._recent: dict[Hashable, tuple[float, Any]] = {}
+        # Bumped by invalidate()
+        self._generation = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Return fn(), sharing one call among concurrent callers of `key`."""
+        now = time.monotonic()
+        with self._lock:
+            recent = self._recent.get(key)
+            if recent is not None and now < recent[0]:
+                return recent[1]
+            call = self._calls.get(key)
+            if (
+                call is not None
+                and recent is not None
+                and now < recent[0] + self.stale_seconds
+            ):
+                # Being refreshed already; serve the previous value meanwhile,
+                # as long as it is not more than twice stale_seconds old
+                return recent[1]
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                generation = self._generation
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                if (
+                    call.error is None
+                    and self.stale_seconds > 0
+                    and generation == self._generation
+                ):
+                    self._remember(key, call.value)
+            call.done.set()
+        return call.value
+
+    def _remember(self, key: Hashable, value: Any) -> None:
+        # Called with the lock held
+        if len(self._recent) >= MAX_RECENT:
+            now = time.monotonic()
+            self._recent = {k: v for k, v in self._recent.items() if v[0] > now}
+            if len(self._recent) >= MAX_RECENT:
+                self._recent.clear()
+        self._recent[key] = (time.monotonic() + self.stale_seconds, value)
+
+    def invalidate(self) -> None:
+        """Forget reused results and running calls, e.g. after a write."""
+        with self._lock:
+            self._generation += 1
+            self._recent.clear()
+            self._calls.clear()
@@ -0,0 +1,73 @@
+# app/workers.py
+"""
+Hooks for serving the app from several worker processes (gunicorn.conf.py).
+
+The app is imported once in the gunicorn master and the workers are
+forked from it, so they share its memory copy-on-write. Anything that
+holds an OS resource must not cross that fork:
+
+- the database engine's pooled connections (the master opened one
+  while creating tables) are dropped in each child and reopened lazily;
+- the job runner starts its threads and process pool only inside a
+  worker, from the app's lifespan;
+- the change tailer (app/changefeed.py) starts its thread inside each
+  worker, so every worker publishes every committed change to its own
+  /calculations/stream connections;
+- passlib's CryptContext and the in-memory stores are plain Python
+  objects and are fine to share, but each worker has its own copy
+  afterwards (users in app.fake_store are only seen by the worker that
+  handled the request).
+"""
+import logging
+import math
+import os
+
+from sqlalchemy import text
+
+from .db import engine
+from .security import pwd_context
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process may actually use: the scheduler affinity mask,
+    capped by a cgroup v2 CPU quota (containers). os.cpu_count() reports
+    the host's CPUs and ignores both.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS or Windows
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(cpus, 1)
+
+
+def before_fork() -> None:
+    """In the master: close connections so children never inherit them."""
+    engine.dispose()
+
+
+def after_fork() -> None:
+    """In a new worker: forget the inherited pool without closing the
+    parent's sockets, so this process opens its own connections."""
+    engine.dispose(close=False)
+
+
+def warmup() -> None:
+    """Open a connection and load the password hasher before serving."""
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception:
+        # The users routes fall back to the in-memory store, so a database
+        # that is not up yet must not stop the worker from starting
+        logger.exception("Database warmup failed")
+    pwd_context.hash("warmup")
@@ -0,0 +1,137 @@
+# benchmarks/bench_workers.py
+"""
+Throughput of the calculation read endpoints vs. gunicorn worker count.
+
+Seeds a temporary SQLite database, then for each worker count starts
+`gunicorn -c gunicorn.conf.py app.main:app` on it and drives
+GET /calculations/{id} and GET /calculations/ from several client
+processes for a fixed time. With enough cores, requests per second
+should grow close to linearly with the number of workers, up to the
+number of CPUs the server can use.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --seconds 10
+
+Clients compete with the server for CPU, so run on a machine with spare
+cores (or point --clients at fewer processes) for clean numbers.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app import models  # noqa: E402
+from app.workers import available_cpus  # noqa: E402
+from tests.database import create_schema, make_engine  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+
+def seed(database_url: str, rows: int) -> None:
+    engine = make_engine(database_url)
+    create_schema(engine)
+    with Session(engine) as db:
+        # No versions: the change counter was already seeded at 0, and rows
+        # stamped above it would have their versions handed out again
+        db.add_all(
+            models.Calculation(a=i, b=2, type="mul", result=i * 2, user_id=1)
+            for i in range(rows)
+        )
+        db.commit()
+    engine.dispose()
+
+
+def start_server(workers: int, port: int, database_url: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        WEB_CONCURRENCY=str(workers),
+        PORT=str(port),
+        DATABASE_URL=database_url,
+    )
+    proc = subprocess.Popen(
+        ["gunicorn", "-c", "gunicorn.conf.py", "app.main:app"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/calculations/1", timeout=1)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"server with {workers} workers did not start")
+
+
+def client(port: int, rows: int, seconds: float, counts) -> None:
+    done = 0
+    end = time.time() + seconds
+    with httpx.Client(base_url=f"http://127.0.0.1:{port}") as http:
+        while time.time() < end:
+            if done % 10 == 0:
+                http.get("/calculations/")
+            else:
+                http.get(f"/calculations/{random.randint(1, rows)}")
+            done += 1
+    counts.put(done)
+
+
+def measure(port: int, rows: int, seconds: float, clients: int) -> float:
+    counts = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=client, args=(port, rows, seconds, counts))
+        for _ in range(clients)
+    ]
+    for p in procs:
+        p.start()
+    total = sum(counts.get() for _ in procs)
+    for p in procs:
+        p.join()
+    return total / seconds
+
+
+def main(argv=None) -> None:
+    cpus = available_cpus()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--workers", type=int, nargs="+",
+        default=[n for n in (1, 2, 4, 8, 16) if n <= cpus] or [1],
+    )
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=2 * cpus)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{tmp}/bench.db"
+        seed(database_url, args.rows)
+
+        print(f"{cpus} CPUs available")
+        print(f"{'workers':>7} {'req/s':>10} {'speedup':>8} {'efficiency':>10}")
+        baseline = None
+        for workers in args.workers:
+            server = start_server(workers, args.port, database_url)
+            try:
+                rate = measure(args.port, args.rows, args.seconds, args.clients)
+            finally:
+                server.terminate()
+                server.wait()
+            baseline = baseline or rate / workers
+            speedup = rate / baseline
+            print(f"{workers:>7} {rate:>10.0f} {speedup:>8.2f} {speedup / workers:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
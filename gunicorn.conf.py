@@ -0,0 +1,42 @@
+# gunicorn.conf.py
+"""
+Production server: gunicorn managing uvicorn worker processes.
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+WEB_CONCURRENCY sets the number of workers (default: one per CPU the
+process may use, respecting affinity and container CPU limits).
+"""
+import os
+
+from app.workers import available_cpus
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Import the app once in the master; workers share it copy-on-write
+preload_app = True
+
+# On SIGTERM, workers stop accepting and get this long to finish requests
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = 5
+
+
+def when_ready(server):
+    from app.workers import before_fork
+
+    before_fork()
+
+
+def post_fork(server, worker):
+    from app.workers import after_fork
+
+    after_fork()
+
+
+def post_worker_init(worker):
+    from app.workers import warmup
+
+    warmup()
@@ -0,0 +1,93 @@
+# tests/database.py
+"""
+Test database helpers, shared by the pytest fixtures and the benchmarks.
+
+By default each process gets its own in-memory SQLite database (one per
+pytest-xdist worker), with the schema created once. Every test then runs
+inside a transaction on a single connection that is rolled back at the
+end, so nothing leaks between tests and the schema is never rebuilt.
+
+Set TEST_DATABASE_URL to run against a real server (e.g. Postgres in CI).
+On PostgreSQL each pytest-xdist worker gets its own schema, so workers
+never share the change counter row or unique columns. Other servers
+have no such isolation: run them without -n.
+"""
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.crud import ensure_change_counter
+from app.db import Base, add_missing_columns
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "sqlite://")
+# "gw0", "gw1", ... under pytest-xdist
+XDIST_WORKER = os.getenv("PYTEST_XDIST_WORKER")
+
+
+def _server_engine(url: str) -> Engine:
+    engine = create_engine(url)
+    if XDIST_WORKER is None or engine.dialect.name != "postgresql":
+        return engine
+
+    schema = f"test_{XDIST_WORKER}"
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+        conn.execute(text(f'CREATE SCHEMA "{schema}"'))
+    engine.dispose()
+    return create_engine(url, connect_args={"options": f"-csearch_path={schema}"})
+
+
+def make_engine(url: str = TEST_DATABASE_URL) -> Engine:
+    if not url.startswith("sqlite"):
+        return _server_engine(url)
+
+    # One shared connection, so an in-memory database outlives sessions
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+
+    # pysqlite's own transaction handling breaks SAVEPOINT; let SQLAlchemy
+    # emit BEGIN itself instead.
+    @event.listens_for(engine, "connect")
+    def _no_implicit_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+def create_schema(engine: Engine) -> None:
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    with sessionmaker(bind=engine)() as db:
+        ensure_change_counter(db)
+
+
+@contextmanager
+def isolated_session_factory(engine: Engine):
+    """
+    Yield a sessionmaker whose sessions all share one outer transaction.
+    commit() inside the app only releases a savepoint; everything is
+    rolled back when the block exits.
+    """
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        yield sessionmaker(
+            bind=connection,
+            autocommit=False,
+            autoflush=False,
+            join_transaction_mode="create_savepoint",
+        )
+    finally:
+        transaction.rollback()
+        connection.close()
@@ -1,36 +1,54 @@
 import os
+
+# Keep the app's own engine off the shared on-disk app.db, so parallel
+# workers never write to the same file
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from app.db import Base, get_db, DATABASE_URL
+from app.db import get_db
+from app.jobs import runner
 from app.main import app
+from tests.database import create_schema, isolated_session_factory, make_engine
 
-# Prefer TEST_DATABASE_URL (used in GitHub Actions)
-TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", DATABASE_URL)
 
-engine = create_engine(
-    TEST_DATABASE_URL,
-    connect_args={"check_same_thread": False} if TEST_DATABASE_URL.startswith("sqlite") else {},
-)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@pytest.fixture(scope="session")
+def engine():
+    # Schema is created once per worker, not per test
+    engine = make_engine()
+    create_schema(engine)
+    yield engine
+    engine.dispose()
 
-# Create all tables for testing
-Base.metadata.create_all(bind=engine)
+
+@pytest.fixture
+def session_factory(engine):
+    with isolated_session_factory(engine) as factory:
+        yield factory
 
 
-def override_get_db():
-    db = TestingSessionLocal()
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
     try:
-        yield db
+        yield session
     finally:
-        db.close()
-
-
-app.dependency_overrides[get_db] = override_get_db
+        session.close()
 
 
 @pytest.fixture
-def client():
-    return TestClient(app)
+def client(session_factory, monkeypatch):
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    monkeypatch.setattr(runner, "session_factory", session_factory)
+    # Never start a process pool from the shared runner in tests
+    monkeypatch.setattr(runner, "workers", 0)
+    yield TestClient(app)
+    app.dependency_overrides.pop(get_db, None)
@@ -1,3 +1,21 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from app import archive, crud, events, models, schemas, singleflight
+from app.archive import archive_calculations, read_archive
+from app.changefeed import ChangeTailer
+from app.events import Broker, Event
+from app.routers import calculations
+from app.singleflight import SingleFlight
+from tests.database import create_schema
+
+
 def register_user(client):
     payload = {
         "username": "calcuser",
@@ -45,3 +63,565 @@ def test_invalid_calculation_type(client):
     resp = client.post(f"/calculations/?owner_id={user_id}", json=payload)
 
     assert resp.status_code >= 400
+
+
+def test_stream_receives_calculation_events(client, session_factory):
+    user_id = register_user(client)
+    # Two server processes, each with its own broker and tailer
+    workers = [ChangeTailer(session_factory, broker=Broker()) for _ in range(2)]
+    for tailer in workers:
+        tailer.poll()
+
+    async def scenario():
+        subs = [tailer.broker.subscribe(user_id=user_id) for tailer in workers]
+
+        async def write(method, url, **kwargs):
+            resp = await asyncio.to_thread(method, url, **kwargs)
+            for tailer in workers:
+                assert tailer.poll() == 1
+            return resp.json()
+
+        created = await write(
+            client.post, f"/calculations/?owner_id={user_id}", json={"a": 2, "b": 3, "type": "mul"}
+        )
+        await write(client.put, f"/calculations/{created['id']}", json={"type": "add"})
+        await write(client.delete, f"/calculations/{created['id']}")
+        for i in range(2):
+            await write(
+                client.post, f"/calculations/?owner_id={user_id}", json={"a": i, "b": 1, "type": "add"}
+            )
+        await write(
+            client.patch,
+            "/calculations/bulk",
+            json={"filter": {"user_id": user_id}, "changes": {"b": 2}},
+        )
+
+        await asyncio.sleep(0)
+        received = []
+        for tailer, sub in zip(workers, subs):
+            received.append([sub.queue.get_nowait() for _ in range(6)])
+            assert sub.queue.empty()
+            tailer.broker.unsubscribe(sub)
+        return created, received
+
+    created, (first, second) = asyncio.run(scenario())
+    # Every process publishes the same events, with versions as ids
+    assert first == second
+    assert [e.type for e in first] == [
+        "created", "updated", "deleted", "created", "created", "bulk",
+    ]
+    assert [e.id for e in first] == list(range(first[0].id, first[0].id + 6))
+    assert first[0].data["id"] == created["id"]
+    assert first[0].data["result"] == 6
+    assert first[1].data["result"] == 5
+    assert first[2].data == {"id": created["id"], "user_id": user_id, "version": first[2].id}
+    assert first[5].data == {"action": "updated", "count": 2, "version": first[5].id}
+
+
+def test_stream_skips_rows_rewritten_while_publishing(client, session_factory, monkeypatch):
+    user_id = register_user(client)
+    tailer = ChangeTailer(session_factory, broker=Broker())
+    tailer.poll()
+    calc = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 1, "b": 1, "type": "add"}
+    ).json()
+    other = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 2, "b": 2, "type": "add"}
+    ).json()
+
+    get_version_rows = crud.get_version_rows
+
+    def rewrite_then_read(db, versions):
+        # Another process updates the first row between the tailer's reads
+        monkeypatch.setattr(crud, "get_version_rows", get_version_rows)
+        row = crud.get_calculation(db, calc["id"])
+        crud.update_calculation(db, row, schemas.CalculationUpdate(b=5))
+        return get_version_rows(db, versions)
+
+    monkeypatch.setattr(crud, "get_version_rows", rewrite_then_read)
+    published = []
+    monkeypatch.setattr(tailer.broker, "publish", published.append)
+    tailer.poll()
+    tailer.poll()
+
+    # The row is reported once, at its new version; no id is repeated
+    assert [(e.type, e.data["id"]) for e in published] == [
+        ("created", other["id"]), ("updated", calc["id"]),
+    ]
+    assert [e.id for e in published] == sorted({e.id for e in published})
+    assert published[-1].data["b"] == 5
+
+
+def _event(id, user_id):
+    return Event(id=id, type="created", user_ids=frozenset({user_id}), data={"id": id})
+
+
+def test_stream_drops_slow_consumer_and_replays():
+    slow_broker = Broker(queue_size=2, buffer_size=4)
+
+    async def scenario():
+        slow_broker.start_at(10)
+        first = slow_broker.publish(_event(11, user_id=1))
+        sub = slow_broker.subscribe(user_id=1)
+        for i in range(12, 15):
+            slow_broker.publish(_event(i, user_id=1))
+        slow_broker.publish(_event(15, user_id=2))
+        await asyncio.sleep(0)
+
+        # Queue overflowed: only the drop sentinel is left
+        assert sub.dropped
+        assert sub.queue.get_nowait() is None
+
+        resumed = slow_broker.subscribe(user_id=1, last_event_id=first.id)
+        replayed = [e.id for e in resumed.backlog]
+
+        # Evicted from the buffer: the client has to refetch
+        gone = slow_broker.subscribe(user_id=1, last_event_id=10)
+        # Seen on a process whose tailer is ahead: wait for what follows
+        ahead = slow_broker.subscribe(user_id=1, last_event_id=17)
+        slow_broker.publish(_event(16, user_id=1))
+        slow_broker.publish(_event(18, user_id=1))
+        await asyncio.sleep(0)
+        return replayed, gone.backlog, ahead.queue.get_nowait().id
+
+    replayed, gone, ahead = asyncio.run(scenario())
+    assert replayed == [12, 13, 14]
+    assert [e.type for e in gone] == ["reset"]
+    assert ahead == 18
+
+
+def test_stream_endpoint_frames(client, monkeypatch):
+    stream_broker = Broker(queue_size=1)
+    monkeypatch.setattr(events, "broker", stream_broker)
+    monkeypatch.setattr(events, "HEARTBEAT_SECONDS", 0.05)
+    stream_broker.start_at(5)
+    for i in (6, 7):
+        stream_broker.publish(_event(i, user_id=1))
+
+    def publish_until_dropped():
+        deadline = time.monotonic() + 5
+        while not stream_broker._subscribers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)  # long enough for a few heartbeats
+        # The stream reads at most one queued event at a time, so this
+        # overflows it and the server closes the stream
+        for i in range(8, 12):
+            stream_broker.publish(_event(i, user_id=1))
+
+    publisher = threading.Thread(target=publish_until_dropped)
+    publisher.start()
+    resp = client.get(
+        "/calculations/stream?owner_id=1", headers={"Last-Event-ID": "5"}
+    )
+    publisher.join()
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    assert resp.headers["cache-control"] == "no-cache"
+    frames = resp.text.split("\n\n")
+    assert frames[0] == "retry: 3000"
+    # Replayed from Last-Event-ID, each as a complete id/event/data frame
+    assert frames[1:3] == [
+        'id: 6\nevent: created\ndata: {"id": 6}',
+        'id: 7\nevent: created\ndata: {"id": 7}',
+    ]
+    assert ": heartbeat" in frames
+    assert frames[-2:] == ["event: dropped\ndata: {}", ""]
+    assert not stream_broker._subscribers
+
+
+def test_stream_endpoint_ends_when_broker_closes(client, monkeypatch):
+    stream_broker = Broker()
+    monkeypatch.setattr(events, "broker", stream_broker)
+
+    def close_once_subscribed():
+        deadline = time.monotonic() + 5
+        while not stream_broker._subscribers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stream_broker.close()
+
+    closer = threading.Thread(target=close_once_subscribed)
+    closer.start()
+    resp = client.get("/calculations/stream")
+    closer.join()
+    # Ends cleanly, with no "dropped" frame
+    assert resp.text == "retry: 3000\n\n"
+
+    # Streams opened while shutting down end straight away
+    assert client.get("/calculations/stream").text == "retry: 3000\n\n"
+
+
+def test_changes_feed_returns_deltas_and_tombstones(client):
+    user_id = register_user(client)
+
+    resp = client.get("/calculations/changes")
+    assert resp.status_code == 200
+    since = resp.json()["version"]
+
+    created = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 8, "b": 2, "type": "div"}
+    ).json()
+    other = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 1, "b": 1, "type": "add"}
+    ).json()
+    client.put(f"/calculations/{created['id']}", json={"type": "sub"})
+    client.delete(f"/calculations/{other['id']}")
+
+    resp = client.get(f"/calculations/changes?since={since}&owner_id={user_id}")
+    assert resp.status_code == 200
+    body = resp.json()
+    by_id = {c["id"]: c for c in body["changes"]}
+    assert set(by_id) == {created["id"], other["id"]}
+    assert by_id[created["id"]]["result"] == 6
+    assert by_id[other["id"]]["deleted"] is True
+    assert body["has_more"] is False
+
+    # Nothing new after the returned version
+    resp = client.get(f"/calculations/changes?since={body['version']}&owner_id={user_id}")
+    assert resp.json()["changes"] == []
+
+    # Paging hands back a version to continue from
+    resp = client.get(f"/calculations/changes?since={since}&owner_id={user_id}&limit=1")
+    page = resp.json()
+    assert page["has_more"] is True
+    assert len(page["changes"]) == 1
+
+
+def test_conditional_get_returns_304(client, monkeypatch):
+    user_id = register_user(client)
+    calc = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 3, "b": 4, "type": "add"}
+    ).json()
+
+    resp = client.get(f"/calculations/{calc['id']}")
+    etag = resp.headers["ETag"]
+    resp = client.get(f"/calculations/{calc['id']}", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    list_etag = client.get("/calculations/").headers["ETag"]
+    get_calculations = crud.get_calculations
+
+    def no_rows(*args, **kwargs):
+        raise AssertionError("rows loaded for an unchanged list")
+
+    monkeypatch.setattr(crud, "get_calculations", no_rows)
+    resp = client.get("/calculations/", headers={"If-None-Match": list_etag})
+    assert resp.status_code == 304
+    monkeypatch.setattr(crud, "get_calculations", get_calculations)
+
+    # A write changes both tags
+    client.put(f"/calculations/{calc['id']}", json={"b": 5})
+    resp = client.get(f"/calculations/{calc['id']}", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.json()["result"] == 8
+    resp = client.get("/calculations/", headers={"If-None-Match": list_etag})
+    assert resp.status_code == 200
+
+
+def test_bulk_update_recomputes_results(client):
+    user_id = register_user(client)
+    ids = [
+        client.post(
+            f"/calculations/?owner_id={user_id}", json={"a": i, "b": 2, "type": "add"}
+        ).json()["id"]
+        for i in range(3)
+    ]
+
+    resp = client.patch(
+        "/calculations/bulk",
+        json={
+            "filter": {"user_id": user_id, "type": "add", "id_lt": ids[-1]},
+            "changes": {"type": "mul"},
+        },
+    )
+    assert resp.status_code == 200
+    assert resp.json()["affected"] == 2
+
+    results = [client.get(f"/calculations/{i}").json() for i in ids]
+    assert [(c["type"], c["result"]) for c in results] == [
+        ("mul", 0), ("mul", 2), ("add", 4),
+    ]
+
+    # Re-typing to div with a zero divisor is refused as a whole
+    resp = client.patch(
+        "/calculations/bulk",
+        json={"filter": {"user_id": user_id}, "changes": {"type": "div", "b": 0}},
+    )
+    assert resp.status_code == 400
+    assert client.get(f"/calculations/{ids[0]}").json()["b"] == 2
+
+    # Division is recomputed in SQL too
+    resp = client.patch(
+        "/calculations/bulk",
+        json={"filter": {"user_id": user_id, "type": "add"}, "changes": {"type": "div"}},
+    )
+    assert resp.json()["affected"] == 1
+    assert client.get(f"/calculations/{ids[-1]}").json()["result"] == 1
+
+    # Columns cannot be set to null
+    for changes in ({"a": None}, {"type": "add", "b": None}):
+        resp = client.patch(
+            "/calculations/bulk", json={"filter": {"user_id": user_id}, "changes": changes}
+        )
+        assert resp.status_code == 400
+    assert client.get(f"/calculations/{ids[0]}").json()["a"] == 0
+
+    # An empty filter would rewrite every row
+    resp = client.patch(
+        "/calculations/bulk", json={"filter": {}, "changes": {"type": "add"}}
+    )
+    assert resp.status_code == 400
+
+
+def test_bulk_delete(client, monkeypatch):
+    monkeypatch.setattr(crud, "BULK_CHUNK_SIZE", 1)
+    user_id = register_user(client)
+    first = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 1, "b": 1, "type": "sub"}
+    ).json()
+    last = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 1, "b": 1, "type": "sub"}
+    ).json()
+
+    assert client.delete("/calculations").status_code == 400
+
+    resp = client.delete(f"/calculations?user_id={user_id}&type=sub&id_lt={last['id']}")
+    assert resp.status_code == 200
+    assert resp.json()["affected"] == 1
+    assert client.get(f"/calculations/{first['id']}").status_code == 404
+    assert client.get(f"/calculations/{last['id']}").status_code == 200
+
+
+def test_browse_by_created_range_and_archive(client, db, tmp_path):
+    user_id = register_user(client)
+    old = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 5, "b": 5, "type": "add"}
+    ).json()
+    new = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 6, "b": 6, "type": "add"}
+    ).json()
+
+    db.query(models.Calculation).filter(models.Calculation.id == old["id"]).update(
+        {"created_at": datetime(1999, 12, 31, 12, 0)}
+    )
+    db.commit()
+
+    resp = client.get("/calculations/?created_to=2000-01-01T00:00:00Z")
+    ids = [c["id"] for c in resp.json()]
+    assert old["id"] in ids
+    assert new["id"] not in ids
+
+    list_etag = client.get("/calculations/").headers["ETag"]
+    archived = archive_calculations(db, datetime(2000, 1, 1, tzinfo=timezone.utc), tmp_path)
+    assert archived["1999-12"] >= 1
+
+    columns = read_archive(tmp_path / "calculations-1999-12")
+    assert old["id"] in columns["id"]
+    assert client.get(f"/calculations/{old['id']}").status_code == 404
+    assert client.get(f"/calculations/{new['id']}").status_code == 200
+
+    # Archiving changes the list, so the old tag no longer matches
+    resp = client.get("/calculations/", headers={"If-None-Match": list_etag})
+    assert resp.status_code == 200
+
+
+def test_rows_from_before_created_at_get_one(tmp_path):
+    # A database made before created_at existed
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE calculations (id INTEGER PRIMARY KEY, a FLOAT NOT NULL,"
+            " b FLOAT NOT NULL, type VARCHAR NOT NULL, result FLOAT, user_id INTEGER)"
+        ))
+        conn.execute(text("INSERT INTO calculations (a, b, type) VALUES (1, 2, 'add')"))
+    create_schema(engine)
+
+    with sessionmaker(bind=engine)() as db:
+        row = db.query(models.Calculation).one()
+        assert row.created_at is not None
+        # ...so it can be found by time range, and archived in due course
+        since = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        assert crud.get_calculations(db, created_from=since) == [row]
+    engine.dispose()
+
+
+def test_archive_runs_in_chunks_and_keeps_versions(client, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "BULK_CHUNK_SIZE", 2)
+    user_id = register_user(client)
+    ids = [
+        client.post(
+            f"/calculations/?owner_id={user_id}", json={"a": i, "b": 1, "type": "add"}
+        ).json()["id"]
+        for i in range(5)
+    ]
+    # The newest version belongs to an old row
+    client.put(f"/calculations/{ids[0]}", json={"b": 2})
+    version = crud.current_version(db)
+
+    db.query(models.Calculation).filter(models.Calculation.id.in_(ids)).update(
+        {"created_at": datetime(1999, 12, 31, 12, 0)}, synchronize_session=False
+    )
+    db.commit()
+
+    # Read two rows at a time, written four to a part
+    archived = archive_calculations(
+        db, datetime(2000, 1, 1, tzinfo=timezone.utc), tmp_path, part_rows=4
+    )
+    assert archived == {"1999-12": 5}
+    assert len(list((tmp_path / "calculations-1999-12").glob("part-*"))) == 2
+    assert sorted(read_archive(tmp_path / "calculations-1999-12")["id"]) == ids
+
+    # Versions are not reused once the row holding the newest one is gone
+    assert crud.current_version(db) == version
+    created = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 1, "b": 1, "type": "add"}
+    ).json()
+    assert created["version"] == version + 1
+    changes = client.get(f"/calculations/changes?since={version}").json()["changes"]
+    assert [c["id"] for c in changes] == [created["id"]]
+
+
+def test_single_flight_shares_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        return "rows"
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(flight.do, "key", load) for _ in range(8)]
+        time.sleep(0.1)
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert results == ["rows"] * 8
+    assert len(calls) == 1
+
+    # Nothing is kept once the call finished
+    flight.do("key", load)
+    assert len(calls) == 2
+
+
+def test_single_flight_reuses_results_within_stale_window():
+    flight = SingleFlight(stale_seconds=60)
+    counter = iter(range(100))
+
+    assert flight.do("key", lambda: next(counter)) == 0
+    assert flight.do("key", lambda: next(counter)) == 0
+    flight.invalidate()
+    assert flight.do("key", lambda: next(counter)) == 1
+
+
+def test_single_flight_drops_calls_started_before_invalidate():
+    flight = SingleFlight(stale_seconds=60)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_load():
+        started.set()
+        release.wait(5)
+        return "before write"
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        stale = pool.submit(flight.do, "key", slow_load)
+        started.wait(5)
+        flight.invalidate()
+        # A reader after the write does not join the older call
+        assert flight.do("key", lambda: "after write") == "after write"
+        release.set()
+        assert stale.result() == "before write"
+
+    # ...and the older call's result is not remembered once it finishes
+    assert flight.do("key", lambda: "fresh") == "after write"
+    flight.invalidate()
+    assert flight.do("key", lambda: "fresh") == "fresh"
+
+
+def test_single_flight_stops_serving_stale_values_after_a_limit(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(singleflight.time, "monotonic", lambda: clock[0])
+    flight = SingleFlight(stale_seconds=1)
+    assert flight.do("key", lambda: "old") == "old"
+
+    started, release = threading.Event(), threading.Event()
+
+    def slow_load():
+        started.set()
+        release.wait(5)
+        return "new"
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        clock[0] = 1.5
+        refresh = pool.submit(flight.do, "key", slow_load)
+        started.wait(5)
+        # Expired, but recently: served while the refresh runs
+        assert flight.do("key", lambda: "unused") == "old"
+
+        # An hour later the old value is not served any more
+        clock[0] = 3600
+        waiting = pool.submit(flight.do, "key", lambda: "unused")
+        time.sleep(0.1)
+        assert not waiting.done()
+        release.set()
+        assert refresh.result() == waiting.result() == "new"
+
+
+def test_tailer_drops_cached_reads(client, session_factory, monkeypatch):
+    monkeypatch.setattr(calculations.reads, "stale_seconds", 60)
+    user_id = register_user(client)
+    calc = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 2, "b": 2, "type": "add"}
+    ).json()
+    assert client.get(f"/calculations/{calc['id']}").json()["result"] == 4
+
+    tailer = ChangeTailer(session_factory, broker=Broker())
+    tailer.listeners.append(calculations.reads.invalidate)
+    tailer.poll()
+    # A write that bypasses the router, as another worker's would
+    db = session_factory()
+    crud.update_calculation(db, crud.get_calculation(db, calc["id"]), schemas.CalculationUpdate(b=3))
+    db.close()
+    assert client.get(f"/calculations/{calc['id']}").json()["result"] == 4
+
+    tailer.poll()
+    assert client.get(f"/calculations/{calc['id']}").json()["result"] == 5
+    calculations.reads.invalidate()
+
+
+def test_reads_see_writes_with_stale_window(client, monkeypatch):
+    monkeypatch.setattr(calculations.reads, "stale_seconds", 60)
+    user_id = register_user(client)
+    calc = client.post(
+        f"/calculations/?owner_id={user_id}", json={"a": 2, "b": 2, "type": "add"}
+    ).json()
+
+    assert client.get(f"/calculations/{calc['id']}").json()["result"] == 4
+    client.put(f"/calculations/{calc['id']}", json={"type": "mul"})
+    assert client.get(f"/calculations/{calc['id']}").json()["type"] == "mul"
+    calculations.reads.invalidate()
+
+
+def test_concurrent_writes_get_distinct_versions(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path}/versions.db", connect_args={"check_same_thread": False}
+    )
+    create_schema(engine)
+    Session = sessionmaker(bind=engine)
+
+    def write(n):
+        with Session() as db:
+            for _ in range(n):
+                crud.create_calculation(
+                    db, schemas.CalculationCreate(a=1, b=1, type="add"), owner_id=1
+                )
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(write, [30] * 8))
+
+    with Session() as db:
+        versions = [v for (v,) in db.query(models.Calculation.version)]
+        assert sorted(versions) == list(range(1, 241))
+        assert crud.current_version(db) == 240
+    engine.dispose()
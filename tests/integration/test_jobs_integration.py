@@ -0,0 +1,170 @@
+from app import crud, jobs
+
+
+def register_user(client):
+    payload = {
+        "username": "jobuser",
+        "email": "job@example.com",
+        "password": "JobPass123"
+    }
+    resp = client.post("/users/register", json=payload)
+    assert resp.status_code in (200, 201)
+    return resp.json()["id"]
+
+
+def test_job_runs_in_chunks(client, session_factory, monkeypatch):
+    runner = jobs.JobRunner(session_factory, workers=0, chunk_size=10)
+    # Tests share one connection, so run the job here once the request is
+    # done rather than in the dispatcher thread
+    submitted = []
+    monkeypatch.setattr(jobs.runner, "submit", submitted.append)
+    user_id = register_user(client)
+
+    items = [{"a": i, "b": 2, "type": "mul"} for i in range(25)]
+    items.append({"a": 1, "b": 0, "type": "div"})
+    resp = client.post(f"/calculations/jobs?owner_id={user_id}", json={"items": items})
+    assert resp.status_code == 202
+    job_id = resp.json()["id"]
+    assert submitted == [job_id]
+    runner.run(job_id)
+
+    job = client.get(f"/calculations/jobs/{job_id}").json()
+    assert job["status"] == "done"
+    assert job["processed"] == 26
+    assert job["failed"] == 1
+
+    first = client.get(f"/calculations/jobs/{job_id}/results?limit=20").json()
+    rest = client.get(
+        f"/calculations/jobs/{job_id}/results?after_id={first[-1]['id']}"
+    ).json()
+    assert [c["result"] for c in first + rest] == [i * 2 for i in range(25)]
+
+
+def test_job_rejects_invalid_type(client):
+    user_id = register_user(client)
+    items = [{"a": 1, "b": 2, "type": "pow"}]
+    resp = client.post(f"/calculations/jobs?owner_id={user_id}", json={"items": items})
+    assert resp.status_code == 400
+
+
+def test_cancelled_job_is_not_run(client, session_factory, monkeypatch):
+    # Keep the job queued so it can be cancelled first
+    monkeypatch.setattr(jobs.runner, "submit", lambda job_id: None)
+    user_id = register_user(client)
+
+    items = [{"a": 1, "b": 1, "type": "add"}] * 5
+    job_id = client.post(
+        f"/calculations/jobs?owner_id={user_id}", json={"items": items}
+    ).json()["id"]
+
+    resp = client.post(f"/calculations/jobs/{job_id}/cancel")
+    assert resp.json()["status"] == "cancelled"
+
+    jobs.JobRunner(session_factory, workers=0).run(job_id)
+    job = client.get(f"/calculations/jobs/{job_id}").json()
+    assert job["status"] == "cancelled"
+    assert job["processed"] == 0
+    assert client.get(f"/calculations/jobs/{job_id}/results").json() == []
+
+    resp = client.post(f"/calculations/jobs/{job_id}/cancel")
+    assert resp.status_code == 409
+
+
+def test_shutdown_leaves_job_running_to_resume(client, session_factory, monkeypatch):
+    runner = jobs.JobRunner(session_factory, workers=0, chunk_size=2)
+    save_job_chunk = crud.save_job_chunk
+
+    def save_then_stop(*args):
+        save_job_chunk(*args)
+        # Shut down while the job is between chunks
+        runner._stopping.set()
+
+    monkeypatch.setattr(crud, "save_job_chunk", save_then_stop)
+    monkeypatch.setattr(jobs.runner, "submit", lambda job_id: None)
+    user_id = register_user(client)
+
+    items = [{"a": i, "b": 1, "type": "add"} for i in range(5)]
+    job_id = client.post(
+        f"/calculations/jobs?owner_id={user_id}", json={"items": items}
+    ).json()["id"]
+
+    runner.run(job_id)
+    job = client.get(f"/calculations/jobs/{job_id}").json()
+    assert job["status"] == "running"
+    assert job["processed"] == 2
+
+    # The next start resumes it from the saved chunk
+    monkeypatch.setattr(crud, "save_job_chunk", save_job_chunk)
+    runner._stopping.clear()
+    runner.run(job_id, resume=True)
+    job = client.get(f"/calculations/jobs/{job_id}").json()
+    assert job["status"] == "done"
+    assert job["processed"] == 5
+    results = client.get(f"/calculations/jobs/{job_id}/results").json()
+    assert [c["result"] for c in results] == [i + 1 for i in range(5)]
+
+
+def test_submitted_job_runs_through_dispatcher_and_pool(client, session_factory, monkeypatch):
+    # Store the job without running it, so the request's session is
+    # closed before the dispatcher thread uses the shared connection
+    monkeypatch.setattr(jobs.runner, "submit", lambda job_id: None)
+    user_id = register_user(client)
+    items = [{"a": i, "b": 3, "type": "mul"} for i in range(7)]
+    job_id = client.post(
+        f"/calculations/jobs?owner_id={user_id}", json={"items": items}
+    ).json()["id"]
+
+    # A real process pool, fed by the dispatcher thread
+    runner = jobs.JobRunner(session_factory, workers=1, chunk_size=3)
+    try:
+        future = runner.submit(job_id)
+        # Already queued: not submitted twice
+        assert runner.submit(job_id) is None
+        future.result(timeout=60)
+    finally:
+        runner.shutdown()
+
+    job = client.get(f"/calculations/jobs/{job_id}").json()
+    assert job["status"] == "done"
+    assert job["processed"] == 7
+    results = client.get(f"/calculations/jobs/{job_id}/results").json()
+    assert [c["result"] for c in results] == [i * 3 for i in range(7)]
+    assert runner._queued == set()
+
+
+def test_cancel_during_last_chunk_is_kept(client, session_factory, monkeypatch):
+    runner = jobs.JobRunner(session_factory, workers=0, chunk_size=2)
+    monkeypatch.setattr(jobs.runner, "submit", lambda job_id: None)
+    user_id = register_user(client)
+    items = [{"a": i, "b": 1, "type": "add"} for i in range(4)]
+    job_id = client.post(
+        f"/calculations/jobs?owner_id={user_id}", json={"items": items}
+    ).json()["id"]
+
+    save_job_chunk = crud.save_job_chunk
+    cancels = []
+
+    def save_then_cancel(db, job, chunk, results):
+        saved = save_job_chunk(db, job, chunk, results)
+        if job.processed == len(items):
+            # Cancelled from another request right after the last chunk
+            cancels.append(client.post(f"/calculations/jobs/{job_id}/cancel"))
+        return saved
+
+    monkeypatch.setattr(crud, "save_job_chunk", save_then_cancel)
+    runner.run(job_id)
+
+    assert cancels[0].json()["status"] == "cancelled"
+    job = client.get(f"/calculations/jobs/{job_id}").json()
+    assert job["status"] == "cancelled"
+    assert job["processed"] == 4
+
+    # The other way round: a finished job cannot be cancelled
+    monkeypatch.setattr(crud, "save_job_chunk", save_job_chunk)
+    job_id = client.post(
+        f"/calculations/jobs?owner_id={user_id}", json={"items": items}
+    ).json()["id"]
+    runner.run(job_id)
+    resp = client.post(f"/calculations/jobs/{job_id}/cancel")
+    assert resp.status_code == 409
+    assert client.get(f"/calculations/jobs/{job_id}").json()["status"] == "done"